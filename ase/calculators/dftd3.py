@@ -1,5 +1,9 @@
+import atexit
 import os
+import re
+import shutil
 import subprocess
+import tempfile
 from warnings import warn
 from pathlib import Path
 
@@ -40,6 +44,7 @@ class DFTD3(BaseCalculator):
                  command=None,  # Command for running dftd3
                  dft=None,  # DFT calculator
                  comm=world,
+                 backend='executable',  # 'executable', 'python' or 'torch'
                  **kwargs):
 
         # Convert from 'func' keyword to 'xc'. Internally, we only store
@@ -66,7 +71,15 @@ class DFTD3(BaseCalculator):
             if dft_xc is not None:
                 kwargs['xc'] = dft_xc
 
-        dftd3 = PureDFTD3(label=label, command=command, comm=comm, **kwargs)
+        if backend == 'executable':
+            dftd3 = PureDFTD3(label=label, command=command, comm=comm,
+                              **kwargs)
+        elif backend == 'python':
+            dftd3 = PythonDFTD3(label=label, comm=comm, **kwargs)
+        elif backend == 'torch':
+            dftd3 = TorchDFTD3(label=label, comm=comm, **kwargs)
+        else:
+            raise ValueError(f'Unknown DFTD3 backend {backend!r}')
 
         # dftd3 only implements energy, forces, and stresses (for periodic
         # systems). But, if a DFT calculator is attached, and that calculator
@@ -91,12 +104,21 @@ class DFTD3(BaseCalculator):
 
     def calculate(self, atoms, properties, system_changes):
         common_props = set(self.dftd3.dftd3_properties) & set(properties)
-        dftd3_results = self._get_properties(atoms, common_props, self.dftd3)
 
         if self.dft is None:
-            results = dftd3_results
+            results = self._get_properties(atoms, common_props, self.dftd3)
         else:
-            dft_results = self._get_properties(atoms, properties, self.dft)
+            # Let dftd3 run while the DFT calculator is busy, if possible.
+            background = self.dftd3.start_in_background(atoms, common_props)
+            try:
+                dft_results = self._get_properties(atoms, properties,
+                                                   self.dft)
+            finally:
+                if background:
+                    self.dftd3.finish_in_background()
+            dftd3_results = self._get_properties(atoms, common_props,
+                                                 self.dftd3)
+
             results = dict(dft_results)
             for name in set(results) & set(dftd3_results):
                 assert np.shape(results[name]) == np.shape(dftd3_results[name])
@@ -136,19 +158,36 @@ class PureDFTD3(FileIOCalculator):
     implemented_properties = list(dftd3_properties)
     default_parameters = dftd3_defaults()
     damping_methods = {'zero', 'bj', 'zerom', 'bjm'}
+    # The dispersion correction depends only on the geometry and the
+    # chemical species, so there is no need to rerun dftd3 when e.g.
+    # the magnetic moments of a spin-polarized DFT calculation change.
+    ignored_changes = {'initial_charges', 'initial_magmoms'}
 
     def __init__(self,
                  *,
                  label='ase_dftd3',  # Label for dftd3 output files
                  command=None,  # Command for running dftd3
                  comm=world,
+                 workdir=None,  # Parent of private scratch directory
                  **kwargs):
 
+        # dftd3 communicates only through files.  Writing them to a
+        # memory-backed filesystem such as /dev/shm can be much faster
+        # than a shared network filesystem.
+        if workdir is None and 'directory' not in kwargs and '/' not in label:
+            workdir = os.environ.get('ASE_DFTD3_WORKDIR')
+        if workdir is not None:
+            directory = tempfile.mkdtemp(prefix='dftd3-', dir=workdir)
+            atexit.register(shutil.rmtree, directory, ignore_errors=True)
+            kwargs['directory'] = directory
+
         super().__init__(label=label,
                          command=command,
                          **kwargs)
 
         self.comm = comm
+        self._sort_cache = None
+        self._process = None
 
     def set(self, **kwargs):
         changed_parameters = {}
@@ -250,6 +289,24 @@ class PureDFTD3(FileIOCalculator):
         return changed_parameters
 
     def calculate(self, atoms, properties, system_changes):
+        self._start_calculation(atoms, properties, system_changes)
+        self._finish_calculation()
+
+    def start_in_background(self, atoms, properties):
+        """Start dftd3 for atoms without waiting for it to finish.
+
+        Returns True if a calculation was started, in which case
+        finish_in_background() must be called to collect the results."""
+        if not self.calculation_required(atoms, properties):
+            return False
+        self._start_calculation(atoms, list(properties),
+                                self.check_state(atoms))
+        return True
+
+    def finish_in_background(self):
+        self._finish_calculation()
+
+    def _start_calculation(self, atoms, properties, system_changes):
         # We don't call FileIOCalculator.calculate here, because that method
         # calls subprocess.call(..., shell=True), which we don't want to do.
         # So, we reproduce some content from that method here.
@@ -266,18 +323,24 @@ class PureDFTD3(FileIOCalculator):
         self.write_input(self.atoms, properties, system_changes)
         # command = self._generate_command()
 
-        inputs = DFTD3Inputs(command=self.command, prefix=self.label,
+        inputs = DFTD3Inputs(command=self.command, prefix=self.prefix,
                              atoms=self.atoms, parameters=self.parameters)
         command = inputs.get_argv(custom_damp=self.custom_damp)
 
-        # Finally, call dftd3 and parse results.
+        # Finally, start dftd3.
         # DFTD3 does not run in parallel
         # so we only need it to run on 1 core
+        if self.comm.rank == 0:
+            with open(self._outname(), 'w') as fd:
+                self._process = subprocess.Popen(command, cwd=self.directory,
+                                                 stdout=fd)
+
+    def _finish_calculation(self):
+        # Wait for dftd3 and parse results.
         errorcode = 0
         if self.comm.rank == 0:
-            with open(self.label + '.out', 'w') as fd:
-                errorcode = subprocess.call(command,
-                                            cwd=self.directory, stdout=fd)
+            errorcode = self._process.wait()
+            self._process = None
 
         errorcode = self.comm.sum(errorcode)
 
@@ -310,7 +373,7 @@ class PureDFTD3(FileIOCalculator):
         if self.comm.rank == 0:
             self._actually_write_input(
                 directory=Path(self.directory), atoms=atoms,
-                properties=properties, prefix=self.label,
+                properties=properties, prefix=self.prefix,
                 damppars=damppars, pbc=pbc)
 
     def _actually_write_input(self, directory, prefix, atoms, properties,
@@ -333,15 +396,18 @@ class PureDFTD3(FileIOCalculator):
                 fd.write(' '.join(damppars))
 
     def _outname(self):
-        return Path(self.directory) / f'{self.label}.out'
+        return Path(self.directory) / f'{self.prefix}.out'
 
     def _read_and_broadcast_results(self):
         from ase.parallel import broadcast
+        # Only the master reads the output files and restores the original
+        # atom order; the other ranks receive the finished results.
         if self.comm.rank == 0:
             output = DFTD3Output(directory=self.directory,
                                  stdout_path=self._outname())
             dct = output.read(atoms=self.atoms,
-                              read_forces=bool(self.parameters['grad']))
+                              read_forces=bool(self.parameters['grad']),
+                              unsort=self._get_unsort())
         else:
             dct = None
 
@@ -352,6 +418,161 @@ class PureDFTD3(FileIOCalculator):
         results = self._read_and_broadcast_results()
         self.results = results
 
+    def _get_unsort(self):
+        # Permutation which undoes the sorting done by write_vasp.
+        # The chemical symbols rarely change between calculations
+        # (relaxations, MD), so we keep the last one around.
+        key = self.atoms.numbers.tobytes()
+        if self._sort_cache is None or self._sort_cache[0] != key:
+            self._sort_cache = (key, _get_unsort(self.atoms))
+        return self._sort_cache[1]
+
+
+class PythonDFTD3(PureDFTD3):
+    """DFTD3 calculator using the simple-dftd3 Python bindings.
+
+    Evaluates the dispersion correction in-process instead of running
+    the dftd3 executable.  This class is an implementation detail."""
+
+    name = 'pythondftd3'
+
+    def __init__(self, *, label='ase_dftd3', comm=world, **kwargs):
+        super().__init__(label=label, comm=comm, **kwargs)
+        self._model = None
+
+    def start_in_background(self, atoms, properties):
+        return False
+
+    def set(self, **kwargs):
+        changed_parameters = PureDFTD3.set(self, **kwargs)
+        if changed_parameters:
+            # The cutoffs are stored in the model.
+            self._model = None
+        return changed_parameters
+
+    def calculate(self, atoms, properties, system_changes):
+        Calculator.calculate(self, atoms, properties, system_changes)
+        from dftd3.interface import DispersionModel
+
+        atoms = self.atoms
+        positions = atoms.positions / Bohr
+        lattice = atoms.cell.array / Bohr
+        if (self._model is None or 'numbers' in system_changes
+                or 'pbc' in system_changes):
+            self._model = DispersionModel(atoms.numbers, positions,
+                                          lattice=lattice,
+                                          periodic=atoms.pbc)
+            self._model.set_realspace_cutoff(
+                self.parameters['cutoff'] / Bohr,
+                self.parameters['cnthr'] / Bohr,
+                self.parameters['cnthr'] / Bohr)
+        else:
+            self._model.update(positions, lattice)
+
+        grad = bool(self.parameters['grad'])
+        res = self._model.get_dispersion(self._get_damping_param(),
+                                         grad=grad)
+
+        self.results['energy'] = res['energy'] * Hartree
+        self.results['free_energy'] = self.results['energy']
+        if grad:
+            self.results['forces'] = -res['gradient'] * Hartree / Bohr
+            if atoms.pbc.any():
+                stress = res['virial'] * Hartree / atoms.get_volume()
+                self.results['stress'] = stress.flat[[0, 4, 8, 5, 2, 1]]
+
+    def _get_damping_param(self):
+        from dftd3.interface import (ZeroDampingParam, RationalDampingParam,
+                                     ModifiedZeroDampingParam,
+                                     ModifiedRationalDampingParam)
+        par = self.parameters
+        if par['old'] or par['tz']:
+            raise NotImplementedError('The D2 method and the "tz" parameters '
+                                      'are only available with the dftd3 '
+                                      'executable')
+
+        damping = par['damping'].lower()
+        param_class = {'zero': ZeroDampingParam,
+                       'bj': RationalDampingParam,
+                       'zerom': ModifiedZeroDampingParam,
+                       'bjm': ModifiedRationalDampingParam}[damping]
+
+        if not self.custom_damp:
+            xc = par.get('xc')
+            if xc is None:
+                xc = 'pbe'
+            return param_class(method=xc.lower(), atm=bool(par['abc']))
+
+        kwargs = dict(s6=float(par['s6']), s8=float(par['s8']),
+                      alp=float(par['alpha6']),
+                      s9=1.0 if par['abc'] else 0.0)
+        if damping in ['zero', 'zerom']:
+            kwargs['rs6'] = float(par['sr6'])
+        else:
+            kwargs['a1'] = float(par['a1'])
+            kwargs['a2'] = float(par['a2'])
+        if damping == 'zero':
+            kwargs['rs8'] = float(par['sr8'])
+        elif damping == 'zerom':
+            kwargs['bet'] = float(par['beta'])
+        return param_class(**kwargs)
+
+
+class TorchDFTD3(PureDFTD3):
+    """DFTD3 calculator using torch-dftd.
+
+    Evaluates the dispersion correction with PyTorch, typically on a GPU
+    (device='cuda').  This only pays off for large systems (hundreds of
+    atoms or more).  This class is an implementation detail."""
+
+    name = 'torchdftd3'
+
+    def __init__(self, *, label='ase_dftd3', comm=world, device='cuda',
+                 **kwargs):
+        super().__init__(label=label, comm=comm, **kwargs)
+        self.device = device
+        self._calc = None
+
+    def start_in_background(self, atoms, properties):
+        return False
+
+    def set(self, **kwargs):
+        changed_parameters = PureDFTD3.set(self, **kwargs)
+        if changed_parameters:
+            self._calc = None
+        return changed_parameters
+
+    def calculate(self, atoms, properties, system_changes):
+        Calculator.calculate(self, atoms, properties, system_changes)
+
+        if self._calc is None:
+            self._calc = self._get_torch_calculator()
+
+        if self.parameters['grad']:
+            properties = ['energy', 'forces', 'stress']
+        else:
+            properties = ['energy']
+        self._calc.calculate(self.atoms, properties, system_changes)
+        self.results.update(self._calc.results)
+
+    def _get_torch_calculator(self):
+        from torch_dftd.torch_dftd3_calculator import TorchDFTD3Calculator
+        par = self.parameters
+        if par['tz'] or self.custom_damp:
+            raise NotImplementedError('Custom damping parameters and the '
+                                      '"tz" parameters are not available '
+                                      'with torch-dftd')
+        xc = par.get('xc')
+        if xc is None:
+            xc = 'pbe'
+        return TorchDFTD3Calculator(device=self.device,
+                                    xc=xc.lower(),
+                                    damping=par['damping'].lower(),
+                                    old=bool(par['old']),
+                                    abc=bool(par['abc']),
+                                    cutoff=par['cutoff'],
+                                    cnthr=par['cnthr'])
+
 
 class DFTD3Inputs:
     dftd3_flags = {'grad', 'pbc', 'abc', 'old', 'tz'}
@@ -361,10 +582,8 @@ class DFTD3Inputs:
         self.prefix = prefix
         self.atoms = atoms
         self.parameters = parameters
-
-    @property
-    def pbc(self):
-        return any(self.atoms.pbc)
+        # Evaluated once; get_argv() needs it several times.
+        self.pbc = bool(atoms.pbc.any())
 
     @property
     def inputformat(self):
@@ -384,9 +603,8 @@ class DFTD3Inputs:
                 xc = 'pbe'
             argv += ['-func', xc.lower()]
 
-        for arg in self.dftd3_flags:
-            if self.parameters.get(arg):
-                argv.append('-' + arg)
+        argv += ['-' + arg for arg in self.dftd3_flags
+                 if self.parameters.get(arg)]
 
         if self.pbc:
             argv.append('-pbc')
@@ -405,7 +623,7 @@ class DFTD3Output:
         self.directory = Path(directory)
         self.stdout_path = Path(stdout_path)
 
-    def read(self, *, atoms, read_forces):
+    def read(self, *, atoms, read_forces, unsort=None):
         results = {}
 
         energy = self.read_energy()
@@ -413,14 +631,14 @@ class DFTD3Output:
         results['free_energy'] = energy
 
         if read_forces:
-            results['forces'] = self.read_forces(atoms)
+            results['forces'] = self.read_forces(atoms, unsort=unsort)
 
         if any(atoms.pbc):
             results['stress'] = self.read_stress(atoms.cell)
 
         return results
 
-    def read_forces(self, atoms):
+    def read_forces(self, atoms, unsort=None):
         forcename = self.directory / 'dftd3_gradient'
         with open(forcename) as fd:
             forces = self.parse_forces(fd)
@@ -433,8 +651,9 @@ class DFTD3Output:
             # This seems to be due to vasp file sorting.
             # If that sorting rule changes, we will get garbled
             # forces!
-            ind = np.argsort(atoms.symbols)
-            forces[ind] = forces.copy()
+            if unsort is None:
+                unsort = _get_unsort(atoms)
+            forces = forces[unsort]
         return forces
 
     def read_stress(self, cell):
@@ -454,51 +673,58 @@ class DFTD3Output:
         with self.stdout_path.open() as fd:
             return self.parse_energy(fd, self.stdout_path)
 
+    # The energy line looks something like this:
+    #
+    #     Edisp /kcal,au,ev: xxx xxx xxx
+    #
+    edisp_re = re.compile(r'^ Edisp /([^:]*):(.*)$', re.M)
+    stopped_re = re.compile(r'^ program stopped.*$', re.M)
+
     def parse_energy(self, fd, outname):
-        for line in fd:
-            if line.startswith(' program stopped'):
-                if 'functional name unknown' in line:
-                    message = ('Unknown DFTD3 functional name. '
-                               'Please check the dftd3.f source file '
-                               'for the list of known functionals '
-                               'and their spelling.')
-                else:
-                    message = ('dftd3 failed! Please check the {} '
-                               'output file and report any errors '
-                               'to the ASE developers.'
-                               ''.format(outname))
-                raise RuntimeError(message)
-
-            if line.startswith(' Edisp'):
-                # line looks something like this:
-                #
-                #     Edisp /kcal,au,ev: xxx xxx xxx
-                #
-                parts = line.split()
-                assert parts[1][0] == '/'
-                index = 2 + parts[1][1:-1].split(',').index('au')
-                e_dftd3 = float(parts[index]) * Hartree
-                return e_dftd3
-
-        raise RuntimeError('Could not parse energy from dftd3 '
-                           'output, see file {}'.format(outname))
+        text = fd.read()
+        match = self.edisp_re.search(text)
+
+        # An error message is only relevant if it comes before the energy.
+        end = len(text) if match is None else match.start()
+        stopped = self.stopped_re.search(text, 0, end)
+        if stopped is not None:
+            if 'functional name unknown' in stopped.group():
+                message = ('Unknown DFTD3 functional name. '
+                           'Please check the dftd3.f source file '
+                           'for the list of known functionals '
+                           'and their spelling.')
+            else:
+                message = ('dftd3 failed! Please check the {} '
+                           'output file and report any errors '
+                           'to the ASE developers.'
+                           ''.format(outname))
+            raise RuntimeError(message)
+
+        if match is None:
+            raise RuntimeError('Could not parse energy from dftd3 '
+                               'output, see file {}'.format(outname))
+
+        index = match.group(1).split(',').index('au')
+        return float(match.group(2).split()[index]) * Hartree
 
     def parse_forces(self, fd):
-        forces = []
-        for i, line in enumerate(fd):
-            forces.append(line.split())
-        return np.array(forces, dtype=float)
+        return np.loadtxt(fd, dtype=float, ndmin=2)
 
     def parse_cellgradient(self, fd):
-        stress = np.zeros((3, 3))
-        for i, line in enumerate(fd):
-            for j, x in enumerate(line.split()):
-                stress[i, j] = float(x)
-        # Check if all stress elements are present?
-        # Check if file is longer?
+        stress = np.loadtxt(fd, dtype=float, max_rows=3, ndmin=2)
+        assert stress.shape == (3, 3)
         return stress
 
 
+def _get_unsort(atoms):
+    # Inverse of the permutation used by write_vasp(sort=True).
+    # Must use the same argsort as write_vasp to get the same order.
+    ind = np.argsort(atoms.symbols)
+    unsort = np.empty_like(ind)
+    unsort[ind] = np.arange(len(ind))
+    return unsort
+
+
 def _get_damppars(par):
     damping = par['damping']
 
@@ -7,7 +7,7 @@ import warnings
 import functools
 from time import time
 from math import sqrt, pi
-from scipy.linalg import qr
+from scipy.linalg import qr, svd
 
 import numpy as np
 
@@ -38,7 +38,9 @@ def lowdin(U, S=None):
        orthonormal matrix, but is more robust.
     """
 
-    L, s, R = np.linalg.svd(U, full_matrices=False)
+    # U is overwritten with the result anyway, so svd may destroy it.
+    L, s, R = svd(U, full_matrices=False, overwrite_a=True,
+                  check_finite=False, lapack_driver='gesdd')
     U[:] = L @ R
 
 
@@ -47,10 +49,13 @@ def neighbor_k_search(k_c, G_c, kpt_kc, tol=1e-4):
     # k1 - k - G + k0 = 0
     alldir_dc = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1],
                           [1, 1, 0], [1, 0, 1], [0, 1, 1]], dtype=int)
-    for k0_c in alldir_dc:
-        for k1, k1_c in enumerate(kpt_kc):
-            if np.linalg.norm(k1_c - k_c - G_c + k0_c) < tol:
-                return k1, k0_c
+    # Test all combinations at once; the first match is found in the same
+    # order as looping over k0 in alldir, then k1 in kpt_kc.
+    dist_dk = np.linalg.norm(kpt_kc[np.newaxis] - k_c - G_c
+                             + alldir_dc[:, np.newaxis], axis=2)
+    d_i, k1_i = np.nonzero(dist_dk < tol)
+    if len(d_i):
+        return int(k1_i[0]), alldir_dc[d_i[0]]
 
     raise ValueError(f'Wannier: Did not find matching kpoint for kpt={k_c}.  '
                      'Probably non-uniform k-point grid')
@@ -96,6 +101,39 @@ def steepest_descent(func, step=.005, tolerance=1e-6, log=silent, **kwargs):
         log('SteepestDescent: iter=%s, value=%s' % (count, fvalue))
 
 
+def conjugate_gradient(func, step=.005, tolerance=1e-6, log=silent,
+                       **kwargs):
+    """Nonlinear conjugate gradient (Polak-Ribiere) minimization.
+
+    Takes a trial step of the given size along each search direction,
+    then moves to where the gradient along that direction vanishes,
+    estimated from the gradients before and after the trial step.
+    This is exact for quadratic functionals."""
+    fvalueold = 0.
+    fvalue = fvalueold + 10
+    count = 0
+    dFold = None
+    while abs((fvalue - fvalueold) / fvalue) > tolerance:
+        fvalueold = fvalue
+        dF = func.get_gradients()
+        if dFold is None:
+            D = dF
+        else:
+            beta = max(0., (np.vdot(dF - dFold, dF).real /
+                            np.vdot(dFold, dFold).real))
+            D = dF + beta * D
+        dFold = dF
+
+        func.step(D * step, **kwargs)
+        slope0 = np.vdot(D, dF).real
+        slope1 = np.vdot(D, func.get_gradients()).real
+        if slope0 > slope1:
+            func.step(D * (step * slope1 / (slope0 - slope1)), **kwargs)
+        fvalue = func.get_functional_value()
+        count += 1
+        log('ConjugateGradient: iter=%s, value=%s' % (count, fvalue))
+
+
 def md_min(func, step=.25, tolerance=1e-6, max_iter=10000,
            log=silent, **kwargs):
 
@@ -1,3 +1,6 @@
+import base64
+import io
+
 import numpy as np
 
 from ase.atoms import Atoms
@@ -8,34 +11,57 @@ from ase.utils import writer, reader
 
 
 @writer
-def write_xsf(fileobj, images, data=None, origin=None, span_vectors=None):
+def write_xsf(fileobj, images, data=None, origin=None, span_vectors=None,
+              fmt='%f', binary_datagrid=False):
+    """Write images and optionally a 3D datagrid to xsf file.
+
+    fmt is the format used for the datagrid values.  A shorter format
+    such as '%.4g' gives smaller files for large grids.  Any format
+    producing plain or scientific notation can be read by read_xsf.
+
+    If binary_datagrid is True, the datagrid is instead stored as
+    base64-encoded 32-bit floats in a BEGIN_BINARY_DATAGRID_3D block.
+    This is much faster to write and read for large grids, but is an ASE
+    extension which other programs do not understand."""
+    # The output is assembled in memory and passed on to fileobj one
+    # image or one datagrid slab at a time, rather than in many small writes.
+    # With writes this large, the file object adds next to nothing over
+    # raw os.write(); nearly all the time goes into formatting.
+    buf = io.StringIO()
+
+    def flush():
+        fileobj.write(buf.getvalue())
+        buf.seek(0)
+        buf.truncate()
+
     is_anim = len(images) > 1
 
     if is_anim:
-        fileobj.write('ANIMSTEPS %d\n' % len(images))
+        buf.write('ANIMSTEPS %d\n' % len(images))
 
     numbers = images[0].get_atomic_numbers()
 
     pbc = images[0].get_pbc()
     npbc = sum(pbc)
     if pbc[2]:
-        fileobj.write('CRYSTAL\n')
+        buf.write('CRYSTAL\n')
         assert npbc == 3
     elif pbc[1]:
-        fileobj.write('SLAB\n')
+        buf.write('SLAB\n')
         assert npbc == 2
     elif pbc[0]:
-        fileobj.write('POLYMER\n')
+        buf.write('POLYMER\n')
         assert npbc == 1
     else:
         # (Header written as part of image loop)
         assert npbc == 0
 
-    cell_variable = False
-    for image in images[1:]:
-        if np.abs(images[0].cell - image.cell).max() > 1e-14:
-            cell_variable = True
-            break
+    # Identical cells are the common case, so check for exact equality
+    # first, and stop at the first cell which differs:
+    cell0 = images[0].cell.array
+    cell_variable = any(np.abs(cell0 - image.cell.array).max() > 1e-14
+                        for image in images[1:]
+                        if not np.array_equal(cell0, image.cell.array))
 
     for n, atoms in enumerate(images):
         anim_token = ' %d' % (n + 1) if is_anim else ''
@@ -43,51 +69,60 @@ def write_xsf(fileobj, images, data=None, origin=None, span_vectors=None):
             write_cell = (n == 0 or cell_variable)
             if write_cell:
                 if cell_variable:
-                    fileobj.write('PRIMVEC%s\n' % anim_token)
+                    buf.write('PRIMVEC%s\n' % anim_token)
                 else:
-                    fileobj.write('PRIMVEC\n')
+                    buf.write('PRIMVEC\n')
                 cell = atoms.get_cell()
                 for i in range(3):
-                    fileobj.write(' %.14f %.14f %.14f\n' % tuple(cell[i]))
+                    buf.write(' %.14f %.14f %.14f\n' % tuple(cell[i]))
 
-            fileobj.write('PRIMCOORD%s\n' % anim_token)
+            buf.write('PRIMCOORD%s\n' % anim_token)
         else:
-            fileobj.write('ATOMS%s\n' % anim_token)
+            buf.write('ATOMS%s\n' % anim_token)
 
         # Get the forces if it's not too expensive:
         calc = atoms.calc
-        if (calc is not None and
-            (hasattr(calc, 'calculation_required') and
-             not calc.calculation_required(atoms, ['forces']))):
-            forces = atoms.get_forces() / Hartree
-        else:
-            forces = None
+        write_forces = (calc is not None and
+                        (hasattr(calc, 'calculation_required') and
+                         not calc.calculation_required(atoms, ['forces'])))
 
-        pos = atoms.get_positions()
+        # Positions and forces are only copied once, straight into one
+        # table which is then formatted with a single %-operation.
+        pos = atoms.positions
 
         if pbc.any():
-            fileobj.write(' %d 1\n' % len(pos))
-        for a in range(len(pos)):
-            fileobj.write(' %2d' % numbers[a])
-            fileobj.write(' %20.14f %20.14f %20.14f' % tuple(pos[a]))
-            if forces is None:
-                fileobj.write('\n')
-            else:
-                fileobj.write(' %20.14f %20.14f %20.14f\n' % tuple(forces[a]))
+            buf.write(' %d 1\n' % len(pos))
+
+        if write_forces:
+            rows = np.empty((len(pos), 7))
+            np.divide(atoms.get_forces(), Hartree, out=rows[:, 4:])
+            coordfmt = ' %2d' + ' %20.14f' * 6
+        else:
+            rows = np.empty((len(pos), 4))
+            coordfmt = ' %2d' + ' %20.14f' * 3
+        rows[:, 0] = numbers
+        rows[:, 1:4] = pos
+        buf.write((coordfmt + '\n') * len(rows) % tuple(rows.ravel().tolist()))
+        flush()
 
     if data is None:
         return
 
-    fileobj.write('BEGIN_BLOCK_DATAGRID_3D\n')
-    fileobj.write(' data\n')
-    fileobj.write(' BEGIN_DATAGRID_3Dgrid#1\n')
+    buf.write('BEGIN_BLOCK_DATAGRID_3D\n')
+    if binary_datagrid:
+        blockname = 'BINARY_DATAGRID_3D'
+    else:
+        blockname = 'DATAGRID_3D'
+
+    buf.write(' data\n')
+    buf.write(' BEGIN_%sgrid#1\n' % blockname)
 
     data = np.asarray(data)
     if data.dtype == complex:
         data = np.abs(data)
 
     shape = data.shape
-    fileobj.write('  %d %d %d\n' % shape)
+    buf.write('  %d %d %d\n' % shape)
 
     cell = atoms.get_cell()
     if origin is None:
@@ -95,27 +130,40 @@ def write_xsf(fileobj, images, data=None, origin=None, span_vectors=None):
         for i in range(3):
             if not pbc[i]:
                 origin += cell[i] / shape[i]
-    fileobj.write('  %f %f %f\n' % tuple(origin))
+    buf.write('  %f %f %f\n' % tuple(origin))
 
     for i in range(3):
         # XXXX is this not just supposed to be the cell?
         # What's with the strange division?
         # This disagrees with the output of Octopus.  Investigate
         if span_vectors is None:
-            fileobj.write('  %f %f %f\n' %
-                          tuple(cell[i] * (shape[i] + 1) / shape[i]))
+            buf.write('  %f %f %f\n' %
+                      tuple(cell[i] * (shape[i] + 1) / shape[i]))
         else:
-            fileobj.write('  %f %f %f\n' % tuple(span_vectors[i]))
-
-    for k in range(shape[2]):
-        for j in range(shape[1]):
-            fileobj.write('   ')
-            fileobj.write(' '.join(['%f' % d for d in data[:, j, k]]))
-            fileobj.write('\n')
-        fileobj.write('\n')
+            buf.write('  %f %f %f\n' % tuple(span_vectors[i]))
+
+    # The x index runs fastest in the file.  Transposing once to a
+    # contiguous array means each row written is contiguous in memory.
+    grid = np.ascontiguousarray(data.T)
+    if binary_datagrid:
+        # One line of base64 per z-slab:
+        grid = grid.astype('<f4')
+        for k in range(shape[2]):
+            buf.write(base64.b64encode(grid[k].tobytes()).decode('ascii'))
+            buf.write('\n')
+            flush()
+    else:
+        # Format a whole z-slab with a single %-operation on Python floats
+        # (tolist() is much cheaper than boxing to NumPy scalars):
+        rowfmt = '   ' + ' '.join([fmt] * shape[0]) + '\n'
+        slabfmt = rowfmt * shape[1] + '\n'
+        for k in range(shape[2]):
+            buf.write(slabfmt % tuple(grid[k].ravel().tolist()))
+            flush()
 
-    fileobj.write(' END_DATAGRID_3D\n')
-    fileobj.write('END_BLOCK_DATAGRID_3D\n')
+    buf.write(' END_%s\n' % blockname)
+    buf.write('END_BLOCK_DATAGRID_3D\n')
+    flush()
 
 
 @reader
@@ -200,19 +248,27 @@ def iread_xsf(fileobj, read_data=False):
                 # We will remember the line until later then.
                 data_header_line = line
 
-        numbers = []
-        positions = []
-        for positionline in lines:
-            tokens = positionline.split()
-            symbol = tokens[0]
-            if symbol.isdigit():
-                numbers.append(int(symbol))
-            else:
-                numbers.append(atomic_numbers[symbol.capitalize()])
-            positions.append([float(x) for x in tokens[1:]])
+        if all(positionline[0].isdigit() for positionline in lines):
+            # Atomic numbers only (as written by ASE), so the whole block
+            # can be parsed as one table of floats:
+            table = np.fromstring(' '.join(lines),
+                                  sep=' ').reshape(len(lines), -1)
+            numbers = table[:, 0].astype(int)
+            positions = table[:, 1:]
+        else:
+            # Split off the atomic number or symbol, then parse all the
+            # remaining columns in one go:
+            tokens = [positionline.split(None, 1) for positionline in lines]
+            numbers = []
+            for symbol, _ in tokens:
+                if symbol.isdigit():
+                    numbers.append(int(symbol))
+                else:
+                    numbers.append(atomic_numbers[symbol.capitalize()])
 
-        positions = np.array(positions)
-        if len(positions[0]) == 3:
+            positions = np.fromstring(' '.join([rest for _, rest in tokens]),
+                                      sep=' ').reshape(len(lines), -1)
+        if positions.shape[1] == 3:
             forces = None
         else:
             forces = positions[:, 3:] * Hartree
@@ -232,7 +288,8 @@ def iread_xsf(fileobj, read_data=False):
         assert line.startswith('BEGIN_BLOCK_DATAGRID_3D')
         readline()  # name
         line = readline()
-        assert line.startswith('BEGIN_DATAGRID_3D')
+        binary = line.startswith('BEGIN_BINARY_DATAGRID_3D')
+        assert binary or line.startswith('BEGIN_DATAGRID_3D')
 
         shape = [int(x) for x in readline().split()]
         assert len(shape) == 3
@@ -249,13 +306,22 @@ def iread_xsf(fileobj, read_data=False):
 
         npoints = np.prod(shape)
 
-        data = []
+        datalines = []
         line = readline()  # First line of data
-        while not line.startswith('END_DATAGRID_3D'):
-            data.extend([float(x) for x in line.split()])
+        while not line.startswith('END_'):
+            datalines.append(line)
             line = readline()
+
+        if binary:
+            assert line.startswith('END_BINARY_DATAGRID_3D')
+            chunks = [base64.b64decode(line) for line in datalines]
+            data = np.frombuffer(b''.join(chunks), dtype='<f4')
+            data = data.astype(float)
+        else:
+            assert line.startswith('END_DATAGRID_3D')
+            data = np.fromstring(' '.join(datalines), sep=' ')
         assert len(data) == npoints
-        data = np.array(data, float).reshape(shape[::-1]).T
+        data = data.reshape(shape[::-1]).T
         # Note that data array is Fortran-ordered
         yield data, origin, span_vectors
 
@@ -0,0 +1,53 @@
+import pytest
+
+from ase.data.s22 import create_s22_system
+from ase.build import bulk
+from ase.calculators.dftd3 import DFTD3, PythonDFTD3
+from ase.calculators.emt import EMT
+from ase.calculators.test import numeric_forces, numeric_stress
+
+pytest.importorskip('dftd3.interface')
+
+
+@pytest.fixture
+def system():
+    return create_s22_system('Adenine-thymine_complex_stack')
+
+
+@pytest.mark.parametrize('kwargs, energy', [
+    (dict(), -0.6681154466652238),
+    (dict(damping='bj'), -1.211193213979179),
+    (dict(damping='zerom', xc='b3lyp'), -1.3369234231047677),
+])
+def test_energy(system, kwargs, energy):
+    # Reference energies are those of the dftd3 executable
+    system.calc = DFTD3(backend='python', **kwargs)
+    assert system.get_potential_energy() == pytest.approx(energy, rel=1e-5)
+
+
+def test_forces_and_stress():
+    atoms = bulk('C') * (2, 1, 1)
+    atoms.rattle(stdev=0.05, seed=3)
+    atoms.calc = DFTD3(backend='python', dft=EMT())
+
+    f_numer = numeric_forces(atoms, d=1e-5)
+    assert atoms.get_forces() == pytest.approx(f_numer, abs=1e-6)
+
+    # The dispersion sum is truncated, so the stress is not quite
+    # as smooth as the forces:
+    s_numer = numeric_stress(atoms, d=1e-5)
+    assert atoms.get_stress() == pytest.approx(s_numer, abs=1e-5)
+
+
+def test_d2_not_implemented(system):
+    system.calc = DFTD3(backend='python', old=True)
+    with pytest.raises(NotImplementedError):
+        system.get_potential_energy()
+
+
+def test_set_cutoff():
+    atoms = bulk('C')
+    atoms.calc = PythonDFTD3()
+    e1 = atoms.get_potential_energy()
+    atoms.calc.set(cutoff=10.0, cnthr=10.0)
+    assert atoms.get_potential_energy() != pytest.approx(e1, rel=1e-8)
@@ -0,0 +1,18 @@
+import pytest
+
+from ase.data.s22 import create_s22_system
+from ase.calculators.dftd3 import DFTD3
+
+pytest.importorskip('torch_dftd.torch_dftd3_calculator')
+
+
+@pytest.mark.parametrize('kwargs, energy', [
+    (dict(), -0.6681154466652238),
+    (dict(damping='bj'), -1.211193213979179),
+])
+def test_energy(kwargs, energy):
+    # Reference energies are those of the dftd3 executable.
+    # torch-dftd works in single precision by default.
+    system = create_s22_system('Adenine-thymine_complex_stack')
+    system.calc = DFTD3(backend='torch', device='cpu', **kwargs)
+    assert system.get_potential_energy() == pytest.approx(energy, rel=1e-4)
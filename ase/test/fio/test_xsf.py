@@ -0,0 +1,44 @@
+import io
+
+import numpy as np
+import pytest
+
+from ase.build import bulk
+from ase.io import write
+from ase.io.xsf import read_xsf
+
+
+@pytest.fixture
+def datagrid():
+    rng = np.random.RandomState(42)
+    return rng.rand(3, 4, 5)
+
+
+@pytest.mark.parametrize('fmt, tol', [('%f', 1e-6), ('%.17g', 1e-15)])
+def test_xsf_datagrid_fmt(datagrid, fmt, tol):
+    atoms = bulk('Si')
+    write('grid.xsf', atoms, data=datagrid, fmt=fmt)
+    with open('grid.xsf') as fd:
+        data, origin, span_vectors, atoms2 = read_xsf(fd, read_data=True)
+    assert atoms2 == atoms
+    assert data.shape == datagrid.shape
+    assert np.abs(data - datagrid).max() < tol
+
+
+def test_xsf_binary_datagrid(datagrid):
+    atoms = bulk('Si')
+    write('grid.xsf', atoms, data=datagrid, binary_datagrid=True)
+    with open('grid.xsf') as fd:
+        data, origin, span_vectors, atoms2 = read_xsf(fd, read_data=True)
+    assert atoms2 == atoms
+    assert data.dtype == float
+    assert np.abs(data - datagrid.astype(np.float32)).max() == 0
+
+
+def test_xsf_read_symbols():
+    # Atoms may be given by symbol or number, also mixed:
+    text = '\n'.join(['ATOMS', 'C 0 0 0', 'h 1 0 0', '1 0 1 0', ''])
+    atoms = read_xsf(io.StringIO(text))
+    assert list(atoms.numbers) == [6, 1, 1]
+    positions = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0]])
+    assert atoms.positions == pytest.approx(positions)